@@ -1,32 +1,159 @@
 import argparse  # Importing the argparse library for command line arguments
+import errno  # Importing the errno library for recognising cross-device moves
 import os  # Importing the os library for interacting with the operating system
-import semver  # Importing the semver library for parsing semantic version strings
+import re  # Importing the re library for matching version strings
+import shutil  # Importing the shutil library for moving directories across filesystems
+import sys  # Importing the sys library for writing output in one call
+from concurrent.futures import ThreadPoolExecutor  # Importing ThreadPoolExecutor for running moves in parallel
+from functools import lru_cache  # Importing lru_cache for memoizing version parsing
+import semver  # Importing the semver library for validating pre-release version strings
 
+# Plain MAJOR.MINOR.PATCH release, the form almost every extension directory uses
+_RELEASE_RE = re.compile(r'^(0|[1-9]\d*)\.(0|[1-9]\d*)\.(0|[1-9]\d*)$')
+# Any version string; the groups hold the major, minor and patch numbers and the pre-release part.
+# Numbers follow the semver grammar (no leading zeros), so only pre-release parts need semver's own check.
+_SEMVER_RE = re.compile(r'^(0|[1-9]\d*)\.(0|[1-9]\d*)\.(0|[1-9]\d*)(?:-([0-9A-Za-z-]+(?:\.[0-9A-Za-z-]+)*))?'
+                        r'(?:\+[0-9A-Za-z-]+(?:\.[0-9A-Za-z-]+)*)?$')
+# Pre-release key of a release version, which sorts after every pre-release of the same version
+_RELEASE = (1,)
+# VS Code target-platform suffix of a platform-specific build, e.g. "-linux-x64"
+_TARGET_RE = re.compile(r'-(win32-(?:x64|arm64|ia32)|linux-(?:x64|arm64|armhf)|alpine-(?:x64|arm64)|'
+                        r'darwin-(?:x64|arm64)|web)$')
+# Hyphens directly followed by a digit, i.e. the places where a version can start in a directory name
+_VERSION_START_RE = re.compile(r'-(?=\d)')
 
-def get_extension_data(extensions_path):
+
+@lru_cache(maxsize=None)  # Bounded by the number of directory entries in a single run
+def parse_version(version_str):
+    """
+    Function to parse a version string, caching the result for repeated strings.
+
+    Args:
+        version_str (str): Version string taken from an extension directory name.
+
+    Returns:
+        tuple: A (major, minor, patch, pre-release key) tuple that compares by semantic version precedence,
+            or None if the string is not a valid version.
+    """
+    match = _RELEASE_RE.match(version_str)  # Fast path: no pre-release or build part to look at
+    if match is not None:
+        major, minor, patch = match.groups()
+        return int(major), int(minor), int(patch), _RELEASE
+    match = _SEMVER_RE.match(version_str)
+    if match is None:
+        return None
+    major, minor, patch, prerelease = match.groups()
+    if prerelease is None:  # Build metadata only, which does not affect precedence
+        return int(major), int(minor), int(patch), _RELEASE
+    if not semver.VersionInfo.is_valid(version_str):  # Let semver enforce the pre-release identifier rules
+        return None
+    # Numeric identifiers sort numerically and before alphanumeric ones, as in semver
+    identifiers = tuple((0, int(part)) if part.isdigit() else (1, part) for part in prerelease.split("."))
+    return int(major), int(minor), int(patch), (0, identifiers)
+
+
+def split_extension_name(extension):
+    """
+    Function to split an extension directory name into the extension name and its version.
+
+    Args:
+        extension (str): Directory name, e.g. "publisher.name-1.2.3" or "publisher.name-1.2.3-linux-x64".
+
+    Returns:
+        tuple: The extension name, its version string and its parsed version, or None if the name contains no
+            valid version. Platform-specific builds are named "publisher.name@target", so builds for different
+            targets (and the universal build) are never compared with each other.
+    """
+    match = _TARGET_RE.search(extension)
+    if match is not None:
+        # The target is not a pre-release: group by name and target, and only accept a plain release version
+        name, _, version_str = extension[:match.start()].rpartition("-")
+        if name and _RELEASE_RE.match(version_str):
+            return f"{name}@{match.group(1)}", version_str, parse_version(version_str)
+        return None
+    name, _, version_str = extension.rpartition("-")  # Fast path: the version follows the last "-"
+    if name and version_str[:1].isdigit():
+        version = parse_version(version_str)
+        if version is not None:
+            return name, version_str, version
+    # Slow path: the version itself contains "-", e.g. a pre-release, so try each "-<digit>" boundary in place
+    for match in _VERSION_START_RE.finditer(extension):
+        version_str = extension[match.end():]
+        version = parse_version(version_str)
+        if version is not None:
+            return extension[:match.start()], version_str, version
+    return None
+
+
+def scan_extensions(extensions_path, skipped=None):
+    """
+    Function to scan a directory and yield each extension as it is found.
+
+    Args:
+        extensions_path (str): Path to the directory containing extensions.
+        skipped (list, optional): A list to collect the names of directories without a valid version.
+
+    Yields:
+        tuple: The extension name and a (version key, version string, directory name) tuple.
+    """
+    has_version_start = _VERSION_START_RE.search  # Bind loop-invariant lookups to locals
+    split_name = split_extension_name
+    with os.scandir(extensions_path) as entries:  # Iterate through each file/directory in the extensions directory
+        for entry in entries:
+            extension = entry.name
+            if extension[:1] == ".":  # Hidden housekeeping entries such as .obsolete or .old_versions
+                continue
+            if not has_version_start(extension):  # Not an extension directory: no "-<digit>" in the name
+                continue
+            if not entry.is_dir(follow_symlinks=False):  # Skip files; the type comes from the cached directory entry
+                continue
+            parsed = split_name(extension)  # Separate the extension name from its semantic version
+            if parsed is None:
+                if skipped is not None:
+                    skipped.append(extension)  # Reported once after the scan instead of per entry
+                continue
+            name, version_str, version = parsed
+            yield name, (version, version_str, extension)
+
+
+def get_extension_data(extensions_path, skipped=None):
     """
     Function to retrieve extension data from a given directory.
 
     Args:
         extensions_path (str): Path to the directory containing extensions.
+        skipped (list, optional): A list to collect the names of directories without a valid version.
 
     Returns:
-        dict: A dictionary containing extension names as keys and lists of semantic versions as values.
+        dict: A dictionary containing extension names as keys. The value is the single version for extensions found
+            once, and a [latest version, older versions, versions equal to the latest] list for extensions found
+            more than once. Versions that only differ from the latest in build metadata have the same precedence,
+            so they are kept next to the latest rather than treated as older.
+            Each version is a (version key, version string, directory name) tuple, so the original strings
+            can be reused for reporting and moving without formatting the version again.
     """
     extension_data = {}
-    for extension in os.listdir(extensions_path):  # Iterate through each file/directory in the extensions directory
-        extension_path = os.path.join(extensions_path, extension)  # Create full path to the extension
-        if os.path.isdir(extension_path):  # Check if the current item is a directory
-            try:
-                name, version = extension.rsplit("-",
-                                                 1)  # Split the filename at the last "-" to separate name and version
-                version = semver.VersionInfo.parse(version)  # Parse the version string as semantic version
-                extension_data.setdefault(name, []).append(
-                    version)  # Store the version in the dictionary under the extension name
-            except ValueError as e:
-                print(f"Error parsing version for {extension}: {e}. Skipping.")
-            except AttributeError:
-                print(f"Error parsing version for {extension}: Invalid format. Skipping.")
+    get_record = extension_data.get  # Bind the loop-invariant method lookup to a local
+    for name, found in scan_extensions(extensions_path, skipped):  # Group the stream in a single pass
+        record = get_record(name)
+        if record is None:
+            extension_data[name] = found  # Most extensions have a single version, so no lists until a second one
+        elif type(record) is tuple:
+            if found[0] > record[0]:
+                extension_data[name] = [found, [record], []]
+            elif found[0] < record[0]:
+                extension_data[name] = [record, [found], []]
+            else:
+                extension_data[name] = [record, [], [found]]
+        elif found[0] > record[0][0]:
+            record[1].append(record[0])  # Demote the previous latest version and everything equal to it
+            record[1].extend(record[2])
+            record[0] = found
+            record[2] = []
+        elif found[0] == record[0][0]:
+            record[2].append(found)  # Same precedence as the latest, so it is never moved
+        else:
+            record[1].append(found)
     return extension_data
 
 
@@ -35,12 +162,15 @@ def find_duplicates(extension_data):
     Function to identify duplicate extensions from the extension data.
 
     Args:
-        extension_data (dict): A dictionary containing extension names as keys and lists of semantic versions as values.
+        extension_data (dict): A dictionary containing extension names as keys and either their single version or
+            a [latest version, older versions, versions equal to the latest] list as values.
 
     Returns:
-        dict: A dictionary containing duplicate extension names as keys and their versions as values.
+        dict: A dictionary containing duplicate extension names as keys and their
+            [latest, older versions, equal versions] lists as values.
     """
-    duplicate_extensions = {name: versions for name, versions in extension_data.items() if len(versions) > 1}
+    duplicate_extensions = {name: record for name, record in extension_data.items()
+                            if type(record) is list and record[1]}  # Only extensions that have older versions
     return duplicate_extensions
 
 
@@ -49,51 +179,111 @@ def get_latest_versions(duplicate_extensions):
     Function to retrieve the latest versions of duplicate extensions.
 
     Args:
-        duplicate_extensions (dict): A dictionary containing duplicate extension names as keys and their versions as values.
+        duplicate_extensions (dict): A dictionary containing duplicate extension names as keys and their
+            [latest, older versions, equal versions] lists as values.
 
     Returns:
         dict: A dictionary containing duplicate extension names as keys and their latest versions as values.
     """
-    latest_versions = {name: max(versions) for name, versions in duplicate_extensions.items()}
+    latest_versions = {name: record[0] for name, record in duplicate_extensions.items()}  # Tracked while scanning
     return latest_versions
 
 
-def show_report(duplicate_extensions, latest_versions):
+def show_report(duplicate_extensions):
     """
     Function to display a report on duplicate extensions and their versions.
 
     Args:
-        duplicate_extensions (dict): A dictionary containing duplicate extension names as keys and their versions as values.
-        latest_versions (dict): A dictionary containing duplicate extension names as keys and their latest versions as values.
+        duplicate_extensions (dict): A dictionary containing duplicate extension names as keys and their
+            [latest, older versions, equal versions] lists as values.
+    """
+    lines = ["Duplicate extensions (excluding latest versions):"]
+    for name, (_, old_versions, _) in duplicate_extensions.items():
+        lines.append(f"* {name} ({', '.join(version_str for _, version_str, _ in old_versions)})")
+    sys.stdout.write("\n".join(lines) + "\n")  # Write the whole report at once
+
+
+def move_extension(old_extension_path, new_extension_path):
+    """
+    Function to move a single extension directory.
+
+    Args:
+        old_extension_path (str): Current path of the extension directory.
+        new_extension_path (str): Path to move the extension directory to.
     """
-    print("Duplicate extensions (excluding latest versions):")
-    for name, versions in duplicate_extensions.items():
-        old_versions = [v for v in versions if v != latest_versions[name]]
-        if old_versions:
-            print(f"* {name} ({', '.join(str(v) for v in old_versions)})")
+    try:
+        os.replace(old_extension_path, new_extension_path)  # A single rename on the same filesystem
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(old_extension_path, new_extension_path)  # Copy and delete across filesystems
 
 
-def remove_duplicates(duplicate_extensions, latest_versions, extensions_path):
+def move_extensions(moves):
+    """
+    Function to move a batch of extension directories.
+
+    Args:
+        moves (list): A list of (source, destination) path pairs.
+
+    Returns:
+        int: The number of moves that failed.
+    """
+    if not moves:
+        return 0
+    lines = []
+    failures = 0
+    try:
+        # The renames are independent of each other, so overlap them on a thread pool (os.replace releases the GIL)
+        with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4, len(moves))) as executor:
+            futures = [(executor.submit(move_extension, old_extension_path, new_extension_path),
+                        old_extension_path, new_extension_path)
+                       for old_extension_path, new_extension_path in moves]
+            for future, old_extension_path, new_extension_path in futures:  # Log every move, in planned order
+                try:
+                    future.result()
+                except OSError as e:
+                    failures += 1
+                    lines.append(f"Failed to move {old_extension_path} to {new_extension_path}: {e}")
+                else:
+                    lines.append(f"Moved {old_extension_path} to {new_extension_path}")
+    finally:
+        if lines:
+            sys.stdout.write("\n".join(lines) + "\n")  # Write the move log at once, even if interrupted
+    return failures
+
+
+def remove_duplicates(duplicate_extensions, extensions_path):
     """
     Function to remove old duplicates of extensions.
 
     Args:
-        duplicate_extensions (dict): A dictionary containing duplicate extension names as keys and their versions as values.
-        latest_versions (dict): A dictionary containing duplicate extension names as keys and their latest versions as values.
+        duplicate_extensions (dict): A dictionary containing duplicate extension names as keys and their
+            [latest, older versions, equal versions] lists as values.
         extensions_path (str): Path to the directory containing extensions.
+
+    Returns:
+        int: The number of old versions that could not be moved.
     """
-    action_for_duplicates = input("Remove old duplicates? (yes/no): ").lower() == "yes"
-    if action_for_duplicates:
-        os.makedirs("old_versions", exist_ok=True)
-        for name, versions in duplicate_extensions.items():
-            for version in versions:
-                if version != latest_versions[name]:
-                    old_extension_path = os.path.join(extensions_path, f"{name}-{version}")
-                    new_extension_path = os.path.join("old_versions", f"{name}-{version}")
-                    os.renames(old_extension_path, new_extension_path)
-                    print(f"Moved {old_extension_path} to {new_extension_path}")
-    else:
+    if not duplicate_extensions:  # Nothing to move, so don't prompt
+        return 0
+    if input("Remove old duplicates? (yes/no): ")[:1] not in ("y", "Y"):
         print("No duplicates removed.")
+        return 0
+    sep = os.sep
+    base = extensions_path.rstrip(sep)  # Joined by hand below; directory names never contain a separator
+    old_versions_dir = "old_versions"
+    if os.stat(extensions_path).st_dev != os.stat(os.curdir).st_dev:
+        # Keep old versions on the same filesystem as the extensions so every move is a single rename
+        old_versions_dir = f"{base}{sep}.old_versions"
+    moves = []  # Collect every (source, destination) pair first so the moves run as one batch
+    for _, old_versions, _ in duplicate_extensions.values():
+        for _, _, extension in old_versions:
+            old_extension_path = f"{base}{sep}{extension}"  # The directory name as found on disk
+            new_extension_path = f"{old_versions_dir}{sep}{extension}"
+            moves.append((old_extension_path, new_extension_path))
+    os.makedirs(old_versions_dir, exist_ok=True)  # Create the destination once for the whole batch
+    return move_extensions(moves)
 
 
 def main():
@@ -103,14 +293,25 @@ def main():
     # extensions_path = "C:\\Users\\stani\\.vscode\\extensions"
     parser = argparse.ArgumentParser(description="Manage duplicate extensions.")
     parser.add_argument("extensions_path", type=str, help="Path to the directory containing extensions")
+    parser.add_argument("-v", "--verbose", action="store_true", help="List extension-like directories skipped for an invalid version")
     args = parser.parse_args()
 
     extensions_path = args.extensions_path  # Using the argument as the path
-    extension_data = get_extension_data(extensions_path)
+    skipped = []
+    extension_data = get_extension_data(extensions_path, skipped)
+    if skipped:
+        count = len(skipped)
+        if count == 1:
+            print("Skipped 1 directory that looks like an extension but has no valid SemVer string.")
+        else:
+            print(f"Skipped {count} directories that look like extensions but have no valid SemVer string.")
+        if args.verbose:
+            print("\n".join(f"* {extension}" for extension in skipped))
     duplicate_extensions = find_duplicates(extension_data)
-    latest_versions = get_latest_versions(duplicate_extensions)
-    show_report(duplicate_extensions, latest_versions)
-    remove_duplicates(duplicate_extensions, latest_versions, extensions_path)
+    del extension_data  # Extensions with a single version are not needed past this point
+    show_report(duplicate_extensions)
+    if remove_duplicates(duplicate_extensions, extensions_path):
+        sys.exit(1)  # Some old versions could not be moved; the log above lists them
 
 
 if __name__ == "__main__":